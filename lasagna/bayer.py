@@ -1,7 +1,6 @@
 from lasagna.imports import *
 import skimage.io
 from decorator import decorator
-from scipy.ndimage.filters import gaussian_laplace, maximum_filter
 import networkx as nx
 import skimage.measure
 import scipy.spatial
@@ -13,8 +12,11 @@ def register_and_offset(images, registration_images=None, verbose=False):
     offsets = register_images(registration_images)
     if verbose:
         print np.array(offsets)
-    aligned = [lasagna.utils.offset(d, o) for d,o in zip(images, offsets)]
-    return np.array(aligned)
+    aligned = np.zeros((len(images),) + np.shape(images[0]), 
+                       dtype=np.asarray(images[0]).dtype)
+    for d, o, out in zip(images, offsets, aligned):
+        lasagna.utils.offset(np.asarray(d), o, out=out)
+    return aligned
 
 def align(data, verbose=False):
     # initial cycle alignment
@@ -59,16 +61,20 @@ def align_(data, verbose=False):
 
 def laplace_only(data, *args, **kwargs):
     from skimage.filters import laplace
-    h, w = data.shape[-2:]
-    arr = []
-    for frame in data.reshape((-1, h, w)):
-        arr += [laplace(frame, *args, **kwargs)]
-    return np.array(arr).reshape(data.shape)
-
-laplace_ndi = applyXY(gaussian_laplace)
+    def f(frame, output):
+        output[:] = laplace(frame, *args, **kwargs)
+    return lasagna.utils.map_frames(f, data, dtype=np.float32)
+
+def laplace_ndi(arr, sigma, threads=4, **kwargs):
+    """Laplacian of gaussian of each frame in float32, see 
+    `lasagna.process.log_frames`. Extra arguments (e.g., mode, cval) are 
+    passed to scipy.ndimage.filters.gaussian_laplace.
+    """
+    return lasagna.process.log_frames(arr, sigma, threads=threads, **kwargs)
     
-def log_ndi(arr, sigma=1, **kwargs):
-    arr_ = -1 * laplace_ndi(arr.astype(float), sigma, **kwargs)
+def log_ndi(arr, sigma=1, threads=4, **kwargs):
+    arr_ = laplace_ndi(arr, sigma, threads=threads, **kwargs)
+    np.negative(arr_, out=arr_)
     arr_[arr_ < 0] = 0
     arr_ /= arr_.max()
     return skimage.img_as_uint(arr_)
@@ -194,17 +200,15 @@ def call(data,foreground,width=5,do_threshold=10000,worst_threshold=3000):
     
     Thresholds are after contrast adjustment.
     """
-    from scipy.ndimage.filters import maximum_filter
     cycles, channels, _, _ = data.shape
     assert foreground.ndim == 2
     foreground = foreground.astype(bool)
 
-    size = (1,1,width,width)
     fore = foreground
 
     # call pixels in the foreground 
     # only keep the max value per cycle
-    maxd = maximum_filter(data, size)
+    maxd = lasagna.process.max_filter(data, width)
     # tie-breaker
     tie_breaker = np.arange(channels) / 100.
     maxd_ = maxd + tie_breaker[None, :, None, None]
@@ -405,13 +409,12 @@ def extract_values(f, width=5, unmix_DO=True):
         data = data.copy()
         data[0, 1:] = unmix(data[0, 1:])
 
-    size = 1,1,width,width
     blobs = find_blobs(data[0])
 
-    # slow
-    maxd = maximum_filter(data[:,1:], size)
     blob_mask = blobs & (cells > 0)
-    values = maxd[:, :, blob_mask]
+    # max over width x width windows at blobs only
+    i, j = np.nonzero(blob_mask)
+    values = lasagna.process.window_max(data[:,1:], i, j, width)
     stringent = mask[blob_mask]
     labels = cells[blob_mask]
 
@@ -5,14 +5,15 @@ import lasagna.utils
 import pandas
 import struct
 import os
+import shutil
 import time
 import PIL.ImageFont
 import PIL.Image
 import PIL.ImageDraw
 import numpy as np
-from numpy.lib.stride_tricks import as_strided
 import regex as re
-import StringIO, pickle, zlib
+import StringIO, pickle, zlib, json
+from collections import OrderedDict
 from lasagna.external.tifffile_old import TiffFile, imsave, imread
 
 imagej_description = ''.join(['ImageJ=1.49v\nimages=%d\nchannels=%d\nslices=%d',
@@ -83,7 +84,7 @@ def fixed_contour(contour):
     return np.array(xy)
 
 
-@lasagna.utils.Memoized
+@lasagna.utils.lru_cache()
 def _get_stack(name):
     data = imread(config.paths.full(name), multifile=False)
     while data.shape[0] == 1:
@@ -93,7 +94,7 @@ def _get_stack(name):
 
 # TODO fix extension of luts and display_ranges when not provided
 def save_stack(name, data, luts=None, display_ranges=None, 
-               resolution=1., compress=0):
+               resolution=1., compress=0, chunks=None):
     """
     :param data: numpy array with 5, 4, 3, or 2 dimensions [TxZxCxYxX]. float64 
         is automatically converted to float32 for ImageJ compatibility
@@ -101,17 +102,37 @@ def save_stack(name, data, luts=None, display_ranges=None,
 
     :param resolution: resolution in microns per pixel
 
-
+    :param chunks: (height, width) of spatial blocks. If provided, or if name 
+        ends with CHUNKED_EXT, data is saved as a chunked store instead of .tif
+        (see `save_chunked`). For chunked stores `compress` is the zlib level.
 
     input ND array dimensions as ([time], [z slice], channel, y, x)
     leading dimensions beyond 5 could be wrapped into time, not implemented
     if no lut provided, use default and pad extra channels with GRAY
     """
-    
-    if name.split('.')[-1] != 'tif':
+    chunked = chunks is not None or name.endswith(CHUNKED_EXT)
+    if chunked:
+        if not name.endswith(CHUNKED_EXT):
+            name += CHUNKED_EXT
+    elif name.split('.')[-1] != 'tif':
         name += '.tif'
     name = os.path.abspath(name)
 
+    if isinstance(data, LazyStack):
+        # keep metadata when exporting a chunked store
+        if luts is None:
+            luts = data.luts
+        if display_ranges is None:
+            display_ranges = data.display_ranges
+        if chunked and data.dtype in (np.uint8, np.uint16, np.float32):
+            # stream chunk by chunk
+            if isinstance(resolution, str):
+                resolution = UM_PER_PX[resolution] * BINNING
+            save_chunked(name, data, luts, display_ranges, resolution=resolution,
+                         chunks=chunks or CHUNKS, level=compress or 1)
+            return
+        data = data[...]
+
     if isinstance(data, list):
         data = np.array(data)
 
@@ -164,6 +185,12 @@ def save_stack(name, data, luts=None, display_ranges=None,
     if not os.path.isdir(os.path.dirname(name)):
         os.makedirs(os.path.dirname(name))
 
+    if chunked:
+        save_chunked(name, data, luts, display_ranges, 
+                     resolution=1. / resolution[0], 
+                     chunks=chunks or CHUNKS, level=compress or 1)
+        return
+
     imsave(name, data, photometric='minisblack',
            description=description, resolution=resolution, compress=compress,
            extratags=[(50838, 'I', len(tag_50838), tag_50838, True),
@@ -217,6 +244,350 @@ def ij_tag_50839(luts, display_ranges):
     return tag + tuple(sum([list(x) for x in luts], []))
 
 
+def read_ij_metadata(filename):
+    """Read LUTs and display ranges stored by `save_stack` (ImageJ tags 50838 
+    and 50839). Returns (luts, display_ranges), either of which may be None.
+    """
+    with TiffFile(filename) as tif:
+        try:
+            tags = tif.pages[0].imagej_tags
+        except AttributeError:
+            return None, None
+    luts, display_ranges = tags.get('luts'), tags.get('ranges')
+    if luts is not None:
+        if isinstance(luts, np.ndarray):
+            luts = [luts]
+        luts = tuple(tuple(int(x) for x in lut) for lut in luts)
+    if display_ranges is not None:
+        display_ranges = tuple(zip(display_ranges[::2], display_ranges[1::2]))
+    return luts, display_ranges
+
+
+# CHUNKED
+CHUNKED_EXT = '.chunks'
+CHUNKS = (512, 512)
+CHUNK_CODECS = ('zlib', 'lz4', 'raw')
+
+
+def save_chunked(name, data, luts=None, display_ranges=None, resolution=1., 
+                 chunks=CHUNKS, codec='zlib', level=1):
+    """Save stack as a directory of separately compressed chunks. Each chunk 
+    holds a single frame (one index in every leading dimension) and a block of
+    `chunks` pixels in the trailing two dimensions. LUTs and display ranges 
+    are kept in the metadata so the store can be exported back to .tif with 
+    `save_stack`; missing display ranges are the min and max of each channel.
+    Data is read one chunk at a time, so a LazyStack is written without 
+    loading it. Chunks are written to a temporary directory that replaces 
+    `name` once complete, so a store can be saved onto its own path. Usually
+    called through `save_stack`.
+
+    :param resolution: microns per pixel
+    :param codec: one of CHUNK_CODECS; lz4 requires the lz4 package
+    :param level: zlib compression level, 1 is fastest
+    """
+    if codec not in CHUNK_CODECS:
+        raise ValueError('codec must be one of %s' % (CHUNK_CODECS,))
+
+    # leading singleton dimensions are dropped, as in read_stack
+    while data.ndim > 2 and data.shape[0] == 1:
+        data = data[0]
+
+    name = name.rstrip('/\\')
+    target = '%s.tmp%d' % (name, os.getpid())
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    try:
+        _write_chunks(target, data, luts, display_ranges, resolution, chunks, 
+                      codec, level)
+    except:
+        shutil.rmtree(target, ignore_errors=True)
+        raise
+
+    # replace a previous store only once this one is complete
+    if os.path.isdir(name):
+        old = '%s.old%d' % (name, os.getpid())
+        os.rename(name, old)
+        os.rename(target, name)
+        shutil.rmtree(old)
+    else:
+        os.rename(target, name)
+
+
+def _write_chunks(name, data, luts, display_ranges, resolution, chunks, codec, 
+                  level):
+    h, w = data.shape[-2:]
+    bh, bw = chunks
+    nchannels = data.shape[-3] if data.ndim > 2 else 1
+    ranges = [(np.inf, -np.inf)] * nchannels
+    for frame_index in np.ndindex(*data.shape[:-2]):
+        channel = frame_index[-1] if frame_index else 0
+        for bi, i in enumerate(range(0, h, bh)):
+            for bj, j in enumerate(range(0, w, bw)):
+                index = frame_index + (slice(i, i + bh), slice(j, j + bw))
+                chunk = np.ascontiguousarray(data[index])
+                key = _chunk_key(frame_index + (bi, bj))
+                with open(os.path.join(name, key), 'wb') as fh:
+                    fh.write(_compress_chunk(chunk.tostring(), codec, level))
+                lo, hi = ranges[channel]
+                ranges[channel] = min(lo, chunk.min()), max(hi, chunk.max())
+
+    if luts is None:
+        luts = DEFAULT_LUTS + (GRAY,) * nchannels
+    if display_ranges is None:
+        display_ranges = ranges
+
+    metadata = {'shape': data.shape, 
+                'dtype': data.dtype.str,
+                'chunks': tuple(chunks),
+                'codec': codec,
+                'luts': [list(x) for x in luts],
+                'display_ranges': [[float(a), float(b)] for a, b in display_ranges],
+                'resolution': resolution}
+    with open(os.path.join(name, 'metadata.json'), 'w') as fh:
+        json.dump(metadata, fh)
+
+
+def _chunk_key(index):
+    return '.'.join(str(i) for i in index)
+
+
+def _compress_chunk(s, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(s, level)
+    if codec == 'lz4':
+        import lz4.block
+        return lz4.block.compress(s)
+    return s
+
+
+def _decompress_chunk(s, codec):
+    if codec == 'zlib':
+        return zlib.decompress(s)
+    if codec == 'lz4':
+        import lz4.block
+        return lz4.block.decompress(s)
+    return s
+
+
+class LazyStack(object):
+    """Array-like stack that reads data on demand. Data is split into chunks 
+    covering a single frame (one index in every leading dimension) and a block 
+    of the trailing two dimensions. Indexing with integers, slices, Ellipsis 
+    and index arrays follows numpy and only reads chunks that overlap the 
+    selection, e.g. `stack[0, 1:, i0:i1, j0:j1]`. Subclasses implement 
+    `_read_chunk`.
+    """
+    luts = None
+    display_ranges = None
+
+    def __init__(self, shape, dtype, chunks):
+        self.shape = tuple(int(x) for x in shape)
+        self.dtype = np.dtype(dtype)
+        self.chunks = tuple(int(x) for x in chunks)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        data = self[...]
+        if dtype is not None:
+            return data.astype(dtype)
+        return data
+
+    def __repr__(self):
+        return '%s(shape=%s, dtype=%s)' % (type(self).__name__, self.shape, self.dtype)
+
+    def _read_chunk(self, index):
+        """Return 2D array for chunk at index (frame index + (block_i, block_j)).
+        """
+        raise NotImplementedError
+
+    def __getitem__(self, key):
+        bounds, residual = _bounding_index(key, self.shape)
+        shape = [hi - lo for lo, hi in bounds]
+        block = np.zeros(shape, dtype=self.dtype)
+        if block.size == 0:
+            return block[tuple(residual)]
+
+        (i0, i1), (j0, j1) = bounds[-2:]
+        bh, bw = self.chunks[-2:]
+        leading = [range(lo, hi) for lo, hi in bounds[:-2]]
+        for frame_index in product(*leading):
+            target = block[tuple(k - lo for k, (lo, _) in zip(frame_index, bounds))]
+            for bi in range(i0 // bh, (i1 - 1) // bh + 1):
+                for bj in range(j0 // bw, (j1 - 1) // bw + 1):
+                    chunk = self._read_chunk(frame_index + (bi, bj))
+                    # overlap of chunk and selection, in image coordinates
+                    a0, a1 = max(i0, bi * bh), min(i1, (bi + 1) * bh)
+                    b0, b1 = max(j0, bj * bw), min(j1, (bj + 1) * bw)
+                    target[a0 - i0:a1 - i0, b0 - j0:b1 - j0] = \
+                        chunk[a0 - bi * bh:a1 - bi * bh, b0 - bj * bw:b1 - bj * bw]
+
+        return block[tuple(residual)]
+
+
+class ChunkedStack(LazyStack):
+    """Stack saved by `save_chunked`. A missing chunk raises IOError.
+    """
+    def __init__(self, name):
+        with open(os.path.join(name, 'metadata.json'), 'r') as fh:
+            metadata = json.load(fh)
+        super(ChunkedStack, self).__init__(metadata['shape'], 
+                                           str(metadata['dtype']),
+                                           metadata['chunks'])
+        self.name = name
+        self.codec = metadata['codec']
+        self.luts = tuple(tuple(x) for x in metadata['luts'])
+        self.display_ranges = tuple(tuple(x) for x in metadata['display_ranges'])
+        self.resolution = metadata['resolution']
+
+    def _read_chunk(self, index):
+        h, w = self.shape[-2:]
+        bh, bw = self.chunks
+        bi, bj = index[-2:]
+        shape = min(bh, h - bi * bh), min(bw, w - bj * bw)
+        filename = os.path.join(self.name, _chunk_key(index))
+        if not os.path.isfile(filename):
+            raise IOError('missing chunk %s of %s' % (_chunk_key(index), self.name))
+        with open(filename, 'rb') as fh:
+            s = fh.read()
+        s = _decompress_chunk(s, self.codec)
+        return np.frombuffer(s, dtype=self.dtype).reshape(shape)
+
+
+def _bounding_index(key, shape):
+    """Convert a numpy index into the bounding range [lo, hi) along each 
+    dimension and an equivalent index into the bounded block.
+    """
+    if not isinstance(key, tuple):
+        key = (key,)
+    if any(k is None for k in key):
+        raise IndexError('np.newaxis is not supported')
+    if Ellipsis in key:
+        i = key.index(Ellipsis)
+        fill = (slice(None),) * (len(shape) - len(key) + 1)
+        key = key[:i] + fill + key[i + 1:]
+    if len(key) > len(shape):
+        raise IndexError('too many indices')
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    bounds, residual = [], []
+    for k, n in zip(key, shape):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(n)
+            ix = range(start, stop, step)
+            if not ix:
+                bounds += [(0, 0)]
+                residual += [slice(0, 0)]
+                continue
+            lo, hi = min(ix), max(ix) + 1
+            if step > 0:
+                residual += [slice(0, hi - lo, step)]
+            else:
+                residual += [slice(hi - 1 - lo, None, step)]
+        elif isinstance(k, (int, long, np.integer)):
+            if not -n <= k < n:
+                raise IndexError('index %d is out of bounds for size %d' % (k, n))
+            lo = k % n
+            hi = lo + 1
+            residual += [0]
+        else:
+            k = np.asarray(k)
+            if k.dtype == bool:
+                k = np.nonzero(k)[0]
+            k = np.where(k < 0, k + n, k)
+            if k.size and (k.min() < 0 or k.max() >= n):
+                raise IndexError('index out of bounds for size %d' % n)
+            lo = int(k.min()) if k.size else 0
+            hi = int(k.max()) + 1 if k.size else 0
+            residual += [k - lo]
+        bounds += [(lo, hi)]
+
+    return bounds, residual
+
+
+# PEAKS
+PEAK_COLUMNS = 'frame', 'i', 'j', 'value'
+
+def sparse_peaks(peaks, cutoff=0, cells=None):
+    """Convert a dense (..., I, J) peak image into a table of nonzero peaks
+    with columns frame (flat index over leading dimensions), i, j and value,
+    in C order. Only peaks with value > cutoff are kept. If a cell label
+    image `cells` is given, adds its label at each peak as column cell.
+    """
+    peaks = np.asarray(peaks)
+    h, w = peaks.shape[-2:]
+    flat = peaks.reshape(-1)
+    index = np.flatnonzero(flat > cutoff)
+    frame, ij = np.divmod(index, h * w)
+    i, j = np.divmod(ij, w)
+    df = pandas.DataFrame(OrderedDict([('frame', frame), ('i', i), ('j', j),
+                                       ('value', flat[index])]))
+    if cells is not None:
+        df['cell'] = np.asarray(cells)[i, j]
+    return df
+
+
+def dense_peaks(df, shape, dtype=None):
+    """Convert a table of peaks from `sparse_peaks` back into an array of
+    `shape`.
+    """
+    dtype = dtype or df['value'].dtype
+    peaks = np.zeros(shape, dtype=dtype)
+    h, w = shape[-2:]
+    frames = peaks.reshape(-1, h, w)
+    frames[df['frame'].values, df['i'].values, df['j'].values] = df['value'].values
+    return peaks
+
+
+def save_peaks(filename, peaks, shape=None, cutoff=0):
+    """Save peaks as a compressed sparse table (.npz). Dense (..., I, J)
+    arrays are converted with `sparse_peaks`, keeping only values > cutoff.
+    The dense shape is stored if known, so `read_peaks` can restore it.
+    """
+    if not isinstance(peaks, pandas.DataFrame):
+        shape = np.shape(peaks)
+        peaks = sparse_peaks(peaks, cutoff=cutoff)
+    arrays = {c: peaks[c].values for c in peaks.columns}
+    for c in ('frame', 'i', 'j'):
+        arrays[c] = arrays[c].astype(np.int32)
+    if shape is not None:
+        arrays['_shape'] = np.array(shape)
+    with open(filename, 'wb') as fh:
+        np.savez_compressed(fh, **arrays)
+
+
+def read_peaks(filename, dense=False):
+    """Read peaks saved by `save_peaks` as a table, or as a dense array if
+    dense=True (requires the stored shape).
+    """
+    with np.load(filename) as npz:
+        shape = tuple(npz['_shape']) if '_shape' in npz.files else None
+        columns = list(PEAK_COLUMNS)
+        columns += sorted(set(npz.files) - set(PEAK_COLUMNS) - {'_shape'})
+        df = pandas.DataFrame(OrderedDict((c, npz[c]) for c in columns))
+    for c in ('frame', 'i', 'j'):
+        df[c] = df[c].astype(int)
+    if dense:
+        if shape is None:
+            raise ValueError('no shape stored in %s' % filename)
+        return dense_peaks(df, shape)
+    return df
+
+
 def parse_MM(s):
     """Parses Micro-Manager MDA filename.
     100X_round1_1_MMStack_A1-Site_15.ome.tif => ('100X', 1,  'A1', 15)
@@ -433,55 +804,116 @@ def show_IJ(data, title='image', imp=None, check_cache=False, **kwargs):
 
 def read_stack(filename, memmap=False, copy=True):
     """Read a .tif file into a numpy array, with optional memory mapping.
+    Chunked stores (see `save_chunked`) are returned as a ChunkedStack, which 
+    reads chunks on demand when indexed.
     """
+    if filename.rstrip('/\\').endswith(CHUNKED_EXT):
+        return ChunkedStack(filename)
     if memmap:
         data = _get_mapped_tif(filename)
     else:
-        # os.stat detects if file has been updated
-        # data = _imread(filename, hash(os.stat(filename)))
-        data = _imread(filename, 0, copy=copy)
+        data = _imread(filename, copy=copy)
         while data.shape[0] == 1:
             data = np.squeeze(data, axis=(0,))
     return data
 
-# @lasagna.utils.Memoized
-def _imread(filename, dummy, copy=True):
-    """Call TiffFile imread. Dummy arg to separately memoize calls.
+def _imread(filename, copy=True):
+    """Call TiffFile imread.
     """
     return imread(filename, multifile=False)
 
-@lasagna.utils.Memoized
+@lasagna.utils.lru_cache()
 def _get_mapped_tif(filename):
-    TF = TiffFile(filename)
-    # check the offsets
-    offsets = []
-    for i in range(len(TF.pages) - 1):
-        offset, shape = TF.pages[i].is_contiguous
-        offsets += [TF.pages[i+1].is_contiguous[0] - (offset + shape)]
-    # doesn't work unless all IFD headers are the same size
-    if not all(np.array(offsets)==offsets[0]):
-        raise IOError('attempted to memmap unequal offsets in:\n%s' % paths.full(f))
-    stride_offset = offsets[0]
-    # adjust strides to account for offset
-    shape = [x for x in TF.series[0].shape if x != 1]
-    strides = np.r_[np.cumprod(shape[::-1])[::-1][1:], [1]] * 2
-    # TODO: figure out what the fuck is going on here
-    skip_count = np.cumprod(shape[-3:0:-1]) # of IFDs skipped over in leading dimensions
-    skip_count = np.r_[[1], skip_count][::-1]
-    strides[:-2] += skip_count.astype(int) * stride_offset
-
-    # make the initial memmap
-    fh = TF.filehandle
-    offset = TF.pages[0].is_contiguous[0]
-    
-    # RHEL and osx are little-endian, ImageJ defaults to big-endian
-    dtype = np.dtype(TF.byteorder + 'u2')
-
-    mm = np.memmap(fh, dtype=dtype, mode='r',
-                                    offset=offset,
-                                    shape=np.prod(shape), order='C')
-    # update the memmap with adjusted strides
-    return as_strided(mm, shape=shape, strides=strides)
+    """Map a .tif into memory without reading pixel data. Pages of contiguous,
+    uncompressed data are viewed directly in the mapped file, in any dtype and 
+    byte order. If pages are evenly spaced the result is a numpy array, 
+    otherwise a TiffStack that reads pages on demand. Compressed or 
+    non-contiguous pages are decoded on demand, keeping a few recent pages.
+    """
+    with TiffFile(filename, multifile=False) as tif:
+        series = tif.series[0]
+        pages = series.pages
+        shape = tuple(series.shape)
+        page_shape = pages[0].shape
+        dtype = np.dtype(tif.byteorder + pages[0].dtype)
+        contiguous = [page.is_contiguous for page in pages]
+
+    # leading singleton dimensions are dropped, as in read_stack
+    while len(shape) > 2 and shape[0] == 1:
+        shape = shape[1:]
+
+    if len(page_shape) != 2 or tuple(shape[-2:]) != tuple(page_shape):
+        # e.g., RGB pages
+        data = imread(filename, multifile=False)
+        while data.shape[0] == 1:
+            data = np.squeeze(data, axis=(0,))
+        return data
+
+    page_bytes = int(np.prod(page_shape)) * dtype.itemsize
+    if all(c is not None and c[1] == page_bytes for c in contiguous):
+        offsets = [c[0] for c in contiguous]
+        mm = np.memmap(filename, dtype=np.uint8, mode='r')
+        spacing = np.diff(offsets)
+        if len(offsets) == 1 or (spacing == spacing[0]).all():
+            # a single strided view over all pages
+            h, w = page_shape
+            page_stride = spacing[0] if len(offsets) > 1 else page_bytes
+            leading = shape[:-2]
+            strides = [int(page_stride * np.prod(leading[i + 1:])) 
+                       for i in range(len(leading))]
+            strides += [w * dtype.itemsize, dtype.itemsize]
+            return np.ndarray(shape, dtype=dtype, buffer=mm, 
+                              offset=offsets[0], strides=strides)
+        return TiffStack(filename, shape, dtype, offsets=offsets, mm=mm)
+
+    return TiffStack(filename, shape, dtype)
+
+
+class TiffStack(LazyStack):
+    """Pages of a .tif read on demand, one chunk per page. If page offsets are
+    provided, pages are zero-copy views into the memory-mapped file `mm`. 
+    Otherwise pages are decoded with TiffFile and the last `cache_size` pages 
+    are kept; close() releases the file and the decoded pages.
+    """
+    def __init__(self, filename, shape, dtype, offsets=None, mm=None, cache_size=8):
+        super(TiffStack, self).__init__(shape, dtype, shape[-2:])
+        self.filename = filename
+        self.offsets = offsets
+        self.mm = mm
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._tif = None
+
+    def _read_chunk(self, index):
+        page = int(np.ravel_multi_index(index[:-2], self.shape[:-2])) if self.ndim > 2 else 0
+        if self.offsets is not None:
+            return np.ndarray(self.shape[-2:], dtype=self.dtype, buffer=self.mm, 
+                              offset=self.offsets[page])
+        if page in self._cache:
+            self._cache[page] = self._cache.pop(page)
+            return self._cache[page]
+        if self._tif is None:
+            self._tif = TiffFile(self.filename, multifile=False)
+        data = self._tif.series[0].pages[page].asarray()
+        self._cache[page] = data
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return data
+
+    @property
+    def cache_nbytes(self):
+        """Most memory held in decoded pages, for lasagna.utils.LRUCache.
+        """
+        if self.offsets is not None:
+            return 0
+        page_bytes = int(np.prod(self.shape[-2:])) * self.dtype.itemsize
+        return self.cache_size * page_bytes
+
+    def close(self):
+        if self._tif is not None:
+            self._tif.close()
+            self._tif = None
+        self._cache.clear()
 
 def grab_image():
     """Return contents of currently selected ImageJ window.
@@ -491,6 +491,12 @@ def tasks():
             task_max_filter(width=5)(),
             task_extract_barcodes()(threshold_DO, index_DO, cycles_seq)]
 
+def run_tasks(processes=8, retries=1):
+    """Run all tiles through every step concurrently.
+    """
+    return tasker.schedule(home, find_files, tasks(), 
+                           processes=processes, retries=retries)
+
 
 # custom hasher for site info
 # ome_tag = ('ome', lambda xs: xs if len(xs) == 25 else None)
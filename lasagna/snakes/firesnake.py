@@ -7,6 +7,9 @@ import fire
 from collections import defaultdict
 import functools
 import os
+import traceback
+
+AUTHKEY_ENV = 'FIRESNAKE_AUTHKEY'
 
 if sys.version_info.major == 2:
     # python 2
@@ -19,6 +22,16 @@ if sys.version_info.major == 2:
     read = lasagna.io.read_stack
     save = lasagna.io.save_stack 
 
+# set by `Snake.serve`. A persistent worker caches tables here, within the 
+# budget shared with lasagna.io caches.
+table_cache = None
+
+def load_table(load, f):
+    if table_cache is None:
+        return load(f)
+    return table_cache(load, f).copy()
+
+
 def load_csv(f):
     with open(f, 'r') as fh:
         txt = fh.readline()
@@ -34,6 +47,10 @@ def load_tif(f):
     return read(f)
 
 
+def load_npz(f):
+    return lasagna.io.read_peaks(f)
+
+
 def save_csv(f, df):
     df.to_csv(f, index=None)
 
@@ -42,6 +59,10 @@ def save_pkl(f, df):
     df.to_pickle(f)
 
 
+def save_npz(f, peaks):
+    lasagna.io.save_peaks(f, peaks)
+
+
 def save_tif(f, data_, **kwargs):
     kwargs = restrict_kwargs(kwargs, save)
     # make sure `data` doesn't come from the Snake method since it's an
@@ -65,9 +86,11 @@ def load_file(f):
     if f.endswith('.tif'):
         return load_tif(f)
     elif f.endswith('.pkl'):
-        return load_pkl(f)
+        return load_table(load_pkl, f)
     elif f.endswith('.csv'):
-        return load_csv(f)
+        return load_table(load_csv, f)
+    elif f.endswith('.npz'):
+        return load_table(load_npz, f)
     else:
         raise ValueError(f)
 
@@ -97,6 +120,8 @@ def save_output(f, x, inputs):
         return save_pkl(f, x)
     elif f.endswith('.csv'):
         return save_csv(f, x)
+    elif f.endswith('.npz'):
+        return save_npz(f, x)
     else:
         raise ValueError('not a recognized filetype: ' + f)
 
@@ -124,33 +149,169 @@ def call_from_fire(f):
 
     If output filename is provided, saves return value of function.
 
-    Supported filetypes are .pkl, .csv, and .tif.
+    Supported filetypes are .pkl, .csv, .tif and .npz (sparse peaks, see 
+    `lasagna.io.save_peaks`).
     """
     def g(input_json=None, output=None):
         
         with open(input_json, 'r') as fh:
             inputs = json.load(fh)
 
-        # remove unused keyword arguments
-        # would be better to remove only the output arguments so 
-        # incorrectly named arguments raise a sensible error
-        inputs = restrict_kwargs(inputs, f)
+        call_with_inputs(f, inputs, output)
 
-        # provide all arguments as keyword arguments
-        kwargs = {x: load_arg(inputs[x]) for x in inputs}
-        try:
-            kwargs['wildcards']['tile'] = int(kwargs['wildcards']['tile'])
-        except KeyError:
-            pass
-        result = f(**kwargs)
+    return functools.update_wrapper(g, f)
 
-        if output:
-            save_output(output, result, inputs)
 
-    return functools.update_wrapper(g, f)
+def call_with_inputs(f, inputs, output=None):
+    """Call `f` on a dictionary of json-decoded arguments, loading filenames
+    and saving the result to `output` if provided.
+    """
+    inputs, kwargs = load_inputs(f, inputs)
+    result = f(**kwargs)
+
+    if output:
+        save_output(output, result, inputs)
+
+
+def load_inputs(f, inputs):
+    """Returns arguments used by `f` and the corresponding keyword arguments, 
+    with filenames replaced by data.
+    """
+    # remove unused keyword arguments
+    # would be better to remove only the output arguments so 
+    # incorrectly named arguments raise a sensible error
+    inputs = restrict_kwargs(inputs, f)
+
+    # provide all arguments as keyword arguments
+    kwargs = {x: load_arg(inputs[x]) for x in inputs}
+    try:
+        kwargs['wildcards']['tile'] = int(kwargs['wildcards']['tile'])
+    except KeyError:
+        pass
+    return inputs, kwargs
+
+
+def batch(method, manifest, prefetch=2):
+    """Run a Snake method over many jobs in one process. The manifest is a json
+    file containing a list of {"inputs": {...}, "output": ...}, one per tile. 
+    Inputs for the next `prefetch` jobs are read in a background thread and 
+    outputs are saved in another, so disk and CPU stay busy. A failed job 
+    doesn't stop the others; raises ValueError listing failures at the end.
+    """
+    from threading import Thread
+    from Queue import Queue
+
+    f = getattr(Snake, '_' + method)
+    with open(manifest, 'r') as fh:
+        jobs = json.load(fh)
+
+    loaded, to_save = Queue(maxsize=prefetch), Queue(maxsize=prefetch)
+    failed = []
+
+    def read():
+        for job in jobs:
+            try:
+                loaded.put((job, load_inputs(f, job['inputs'])))
+            except Exception:
+                loaded.put((job, traceback.format_exc()))
+
+    def write():
+        while True:
+            item = to_save.get()
+            if item is None:
+                return
+            output, result, inputs = item
+            try:
+                save_output(output, result, inputs)
+            except Exception:
+                failed.append((output, traceback.format_exc()))
+
+    threads = Thread(target=read), Thread(target=write)
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for _ in jobs:
+        job, loaded_ = loaded.get()
+        output = job.get('output')
+        if isinstance(loaded_, basestring):
+            failed.append((output, loaded_))
+            continue
+        inputs, kwargs = loaded_
+        try:
+            result = f(**kwargs)
+        except Exception:
+            failed.append((output, traceback.format_exc()))
+            continue
+        if output:
+            to_save.put((output, result, inputs))
+
+    to_save.put(None)
+    threads[1].join()
+
+    if failed:
+        for output, tb in failed:
+            print('%s failed:\n%s' % (output, tb))
+        raise ValueError('%d of %d jobs failed: %s' % 
+            (len(failed), len(jobs), [output for output, _ in failed]))
+
+
+def serve(port=0, cache_bytes=None):
+    """Persistent worker. Listens on localhost for json-encoded requests 
+    {"method": ..., "inputs": {...}, "output": ..., "cwd": ...}, or a 
+    "manifest" for `batch` in place of inputs and output, and replies 
+    {"status": "ok"} or {"status": "error", "traceback": ...}. Imported modules
+    stay loaded between requests. Input tables, together with memory-mapped
+    images and other values cached by lasagna.io, are kept in the shared 
+    lasagna.utils cache budget, set to `cache_bytes` if given (default 
+    LASAGNA_CACHE_BYTES). The listening port is printed on the first line of
+    stdout. The authkey is read from FIRESNAKE_AUTHKEY.
+    """
+    from multiprocessing.connection import Listener
+    global table_cache
+    if cache_bytes is not None:
+        lasagna.utils.set_cache_budget(max_bytes=cache_bytes)
+    table_cache = lasagna.utils.LRUCache(lambda load, f: load(f))
+
+    authkey = os.environ.get(AUTHKEY_ENV)
+    listener = Listener(('localhost', port), authkey=authkey)
+    print(listener.address[1])
+    sys.stdout.flush()
+    # nobody reads stdout after the port
+    sys.stdout = sys.stderr
+
+    while True:
+        conn = listener.accept()
+        try:
+            while True:
+                request = json.loads(conn.recv_bytes())
+                if request['method'] == 'shutdown':
+                    conn.close()
+                    listener.close()
+                    return
+                conn.send_bytes(json.dumps(serve_request(request)))
+        except EOFError:
+            # client went away, wait for the next one
+            conn.close()
+
+
+def serve_request(request):
+    try:
+        os.chdir(request.get('cwd', os.getcwd()))
+        if 'manifest' in request:
+            batch(request['method'], request['manifest'])
+        else:
+            f = getattr(Snake, '_' + request['method'])
+            call_with_inputs(f, request['inputs'], request.get('output'))
+        return {'status': 'ok'}
+    except Exception:
+        return {'status': 'error', 'traceback': traceback.format_exc()}
 
 
 class Snake():
+    serve = staticmethod(serve)
+    batch = staticmethod(batch)
+
     @staticmethod
     def add_method(class_, name, f):
         f = staticmethod(f)
@@ -270,6 +431,9 @@ class Snake():
 
     @staticmethod
     def _find_peaks(data, cutoff=50):
+        """Peaks below cutoff are set to zero. If the output is .npz, only
+        nonzero peaks are stored (see `lasagna.io.save_peaks`).
+        """
         if data.ndim == 2:
             data = [data]
         peaks = [lasagna.process.find_peaks(x) 
@@ -282,20 +446,20 @@ class Snake():
 
     @staticmethod
     def _max_filter(data, width=5):
-        import scipy.ndimage.filters
-
         if data.ndim == 3:
             data = data[None]
         maxed = np.zeros_like(data)
-        maxed[:, 1:] = scipy.ndimage.filters.maximum_filter(data[:,1:], size=(1, 1, width, width))
+        lasagna.process.max_filter(data[:, 1:], width, out=maxed[:, 1:])
         maxed[:, 0] = data[:, 0] # DAPI
 
         return maxed
 
     @staticmethod
     def _extract_barcodes(peaks, data_max, cells, 
-        threshold_DO, cycles, wildcards, index_DO=None):
-        """
+        threshold_DO, cycles, wildcards, index_DO=None, width=None):
+        """If `width` is given, data_max is LoG data that has not been max 
+        filtered, and the max over the width x width window around each peak 
+        is gathered directly.
         """
 
         if data_max.ndim == 3:
@@ -304,10 +468,29 @@ class Snake():
             index_DO = Ellipsis
 
         data_max = data_max[:, 1:] # no DAPI
-        blob_mask = (peaks[index_DO] > threshold_DO) & (cells > 0)
-        values = data_max[:, :, blob_mask].transpose([2, 0, 1])
-        labels = cells[blob_mask]
-        positions = np.array(np.where(blob_mask)).T
+        if isinstance(peaks, pd.DataFrame):
+            # sparse peaks from .npz, frame indexes the first dimension of the
+            # (frames, I, J) array saved by _find_peaks, as in peaks[index_DO]
+            index = index_DO if isinstance(index_DO, tuple) else (index_DO,)
+            if index == (Ellipsis,):
+                index = (0,)
+            if len(index) != 1:
+                raise ValueError('index_DO must select one frame of peaks: %s' 
+                                 % (index_DO,))
+            frame = int(index[0])
+            peaks = peaks[(peaks['frame'] == frame) & (peaks['value'] > threshold_DO)]
+            i, j = peaks['i'].values, peaks['j'].values
+            keep = cells[i, j] > 0
+            i, j = i[keep], j[keep]
+        else:
+            i, j = np.nonzero((peaks[index_DO] > threshold_DO) & (cells > 0))
+        if width is None:
+            values = data_max[:, :, i, j].transpose([2, 0, 1])
+        else:
+            values = lasagna.process.window_max(data_max, i, j, width)
+            values = values.transpose([2, 0, 1])
+        labels = cells[i, j]
+        positions = np.array([i, j]).T
 
         index = ('cycle', cycles), ('channel', list('GTAC'))
         try:
@@ -325,6 +508,7 @@ class Snake():
            )
         for k,v in wildcards.items():
             df[k] = v
+        df['id'] = object_ids(df['cell'], wildcards)
 
         return df
 
@@ -384,54 +568,43 @@ class Snake():
         return Snake._extract_phenotype_translocation(data_phenotype, inner_ring, perimeter, wildcards)
 
     @staticmethod
-    def _extract_phenotype_translocation(data_phenotype, nuclei, cells, wildcards):
-        from lasagna.pipelines._20170914_endo import feature_table_stack
-        from lasagna.process import feature_table, default_object_features
-
-        def correlate_dapi_gfp(region):
-            dapi, gfp = region.intensity_image_full
-
-            filt = dapi > 0
-            if filt.sum() == 0:
-                # assert False
-                return np.nan
-
-            dapi = dapi[filt]
-            gfp  = gfp[filt]
-            corr = (dapi - dapi.mean()) * (gfp - gfp.mean()) / (dapi.std() * gfp.std())
-
-            return corr.mean()
-
-        
-        def masked(region, index):
-            return region.intensity_image_full[index][region.filled_image]
-
+    def _extract_phenotype_translocation(data_phenotype, nuclei, cells, wildcards,
+                                         region_corr=False):
+        """With region_corr=True, also reports DAPI/GFP correlations over the 
+        pixels of each region rather than its bounding box 
+        (dapi_gfp_nuclear_region_corr, dapi_gfp_cell_region_corr).
+        """
+        nuclear = translocation_features(data_phenotype, nuclei, region_corr)
         features_nuclear = {
-            'dapi_gfp_nuclear_corr' : correlate_dapi_gfp,
-            'dapi_nuclear_median': lambda r: np.median(masked(r, 0)),
-            'gfp_nuclear_median' : lambda r: np.median(masked(r, 1)),
-            'gfp_nuclear_mean' : lambda r: masked(r, 1).mean(),
-            'dapi_nuclear_int'   : lambda r: masked(r, 0).sum(),
-            'gfp_nuclear_int'    : lambda r: masked(r, 1).sum(),
-            'dapi_nuclear_max'   : lambda r: masked(r, 0).max(),
-            'gfp_nuclear_max'    : lambda r: masked(r, 1).max(),
-            'area_nuclear'       : lambda r: r.area,
-            'cell'               : lambda r: r.label
+            'dapi_gfp_nuclear_corr' : nuclear['dapi_gfp_corr'],
+            'dapi_nuclear_median': nuclear['dapi_median'],
+            'gfp_nuclear_median' : nuclear['gfp_median'],
+            'gfp_nuclear_mean'   : nuclear['gfp_mean'],
+            'dapi_nuclear_int'   : nuclear['dapi_sum'],
+            'gfp_nuclear_int'    : nuclear['gfp_sum'],
+            'dapi_nuclear_max'   : nuclear['dapi_max'],
+            'gfp_nuclear_max'    : nuclear['gfp_max'],
+            'area_nuclear'       : nuclear['area'],
+            'cell'               : nuclear['label'],
         }
 
+        cell = translocation_features(data_phenotype, cells, region_corr)
         features_cell = {
-            'dapi_gfp_cell_corr' : correlate_dapi_gfp,
-            'gfp_cell_median' : lambda r: np.median(masked(r, 1)),
-            'gfp_cell_mean' : lambda r: masked(r, 1).mean(),
-            'gfp_cell_int'    : lambda r: masked(r, 1).sum(),
-            'area_cell'       : lambda r: r.area,
-            'cell'            : lambda r: r.label
+            'dapi_gfp_cell_corr' : cell['dapi_gfp_corr'],
+            'gfp_cell_median' : cell['gfp_median'],
+            'gfp_cell_mean'   : cell['gfp_mean'],
+            'gfp_cell_int'    : cell['gfp_sum'],
+            'area_cell'       : cell['area'],
+            'cell'            : cell['label'],
         }
-
-        df_n =  Snake._extract_phenotype(data_phenotype, nuclei, wildcards, features_nuclear)
-
-        df_c =  Snake._extract_phenotype(data_phenotype, cells, wildcards, features_cell) 
-        df_c = df_c[features_cell.keys()]
+        if region_corr:
+            features_nuclear['dapi_gfp_nuclear_region_corr'] = \
+                nuclear['dapi_gfp_region_corr']
+            features_cell['dapi_gfp_cell_region_corr'] = cell['dapi_gfp_region_corr']
+
+        df_n = pd.DataFrame(features_nuclear)
+        df_n = Snake._annotate_phenotype(df_n, nuclei, wildcards)
+        df_c = pd.DataFrame(features_cell)[features_cell.keys()]
         
         df = (pd.concat([df_n.set_index('cell'), df_c.set_index('cell')], axis=1, join='inner')
                 .reset_index())
@@ -441,9 +614,13 @@ class Snake():
     @staticmethod
     def _extract_phenotype(data_phenotype, nuclei, wildcards, features):
         from lasagna.pipelines._20170914_endo import feature_table_stack
-        from lasagna.process import feature_table, default_object_features
 
         df = feature_table_stack(data_phenotype, nuclei, features)
+        return Snake._annotate_phenotype(df, nuclei, wildcards)
+
+    @staticmethod
+    def _annotate_phenotype(df, nuclei, wildcards):
+        from lasagna.process import feature_table, default_object_features
 
         features = default_object_features.copy()
         features['cell'] = features.pop('label')
@@ -452,16 +629,52 @@ class Snake():
 
         for k,v in wildcards.items():
             df[k] = v
+        df['id'] = object_ids(df['cell'], wildcards)
         
         return df
 
 ###
 
+def object_ids(cells, wildcards):
+    """Integer cell IDs, unique across wells and tiles.
+    """
+    return lasagna.utils.object_ids(cells, file=wildcards.get('well', ''), 
+                                    tile=wildcards.get('tile', 0))
+
+def translocation_features(data_phenotype, labels, region_corr=False):
+    """DAPI and GFP statistics over each labeled region (holes filled, as 
+    with regionprops filled_image), computed for all regions at once from 
+    `lasagna.process.packed_regions`. DAPI/GFP correlations use pixels with
+    DAPI > 0 in the bounding box of each region (dapi_gfp_corr) and, if 
+    region_corr is True, in the region itself (dapi_gfp_region_corr).
+    """
+    packed = lasagna.process.packed_regions(labels, data_phenotype[:2], 
+                                            fill_holes=True)
+    dapi = lasagna.process.packed_reductions(packed, 0, ['median', 'sum', 'max'])
+    gfp = lasagna.process.packed_reductions(packed, 1, 
+                                            ['median', 'mean', 'sum', 'max'])
+    # sums of integer images stay integers
+    dtype = int if packed['values'].dtype.kind in 'uib' else float
+
+    features = {'label': packed['labels'].astype(int),
+                'area': np.bincount(np.asarray(labels).ravel())[packed['labels']],
+                'dapi_gfp_corr': lasagna.process.bbox_correlation(labels, 
+                                    data_phenotype[0], data_phenotype[1], 
+                                    where=data_phenotype[0], 
+                                    index=packed['labels'])}
+    if region_corr:
+        features['dapi_gfp_region_corr'] = lasagna.process.packed_correlation(
+                                                packed, 0, 1, where=0)
+    for name, values in (('dapi', dapi), ('gfp', gfp)):
+        for reduction, x in values.items():
+            features['%s_%s' % (name, reduction)] = x
+        features[name + '_sum'] = values['sum'].astype(dtype)
+    return features
+
 def fix_channel_offsets(data, channel_offsets):
-    d = data.transpose([1, 0, 2, 3])
-    x = [lasagna.utils.offset(a, b) for a,b in zip(d, channel_offsets)]
-    x = np.array(x).transpose([1, 0, 2, 3])
-    return x
+    offsets = np.zeros(data.shape[:2] + (2,))
+    offsets[:] = np.array(channel_offsets)[None]
+    return lasagna.utils.offset_stack(data, offsets)
 
 def stitch_input_sites(tile, site_shape, tile_shape):
     """Map tile ID onto site IDs. Fill in wildcards ourselves.
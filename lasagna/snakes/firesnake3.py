@@ -3,9 +3,18 @@ import uuid
 import json
 import os
 import shutil
+import queue
+import atexit
+import subprocess
+from multiprocessing.connection import Client
 
 WIN_PYTHON2 = ['C:\ProgramData\Miniconda2\python.exe', 'C:\ProgramData\Anaconda2\python.exe']
 FIRESNAKE2 = __file__.replace('firesnake3', 'firesnake')
+AUTHKEY_ENV = 'FIRESNAKE_AUTHKEY'
+
+# idle persistent workers, see `start_workers`
+_workers = queue.Queue()
+_processes = []
 
 def stitch_input(wildcards):
     # doesn't respect wildcard constraints
@@ -17,21 +26,87 @@ def stitch_input(wildcards):
     return inputs
 
 def dump_json(**info):
+    return write_json(info, 'input')
+
+def write_json(x, prefix):
     if not os.path.isdir('json'):
         print('creating json directory...')
         os.mkdir('json')
-    name = 'json/input_%s.json' % uuid.uuid4()
+    name = 'json/%s_%s.json' % (prefix, uuid.uuid4())
     with open(name, 'w') as fh:
-        json.dump(info, fh)
+        json.dump(x, fh)
     return name
 
 def call_firesnake(method, output, **info):
+    """Run a firesnake method in python 2. Uses a persistent worker if 
+    `start_workers` was called, otherwise a new python 2 process.
+    """
+    if _processes:
+        return call_worker(method, output, **info)
     json_name = dump_json(**info)
-    from subprocess import call
     cmd = [find_python2(), FIRESNAKE2, method, 
             '--input_json', json_name,
             '--output', str(output)]
-    call(cmd)
+    subprocess.call(cmd)
+
+def call_firesnake_batch(method, jobs):
+    """Run a firesnake method over many tiles in one python 2 process. Each
+    job is a dictionary of arguments, including `output`. Writes a single
+    manifest instead of one json file per job.
+    """
+    manifest = [{'output': str(job['output']), 
+                 'inputs': {k: v for k, v in job.items() if k != 'output'}}
+                for job in jobs]
+    json_name = write_json(manifest, 'batch')
+
+    if _processes:
+        return send_request({'method': method, 'manifest': json_name})
+    cmd = [find_python2(), FIRESNAKE2, 'batch', method, json_name]
+    if subprocess.call(cmd) != 0:
+        raise RuntimeError('firesnake batch %s failed' % method)
+
+def call_worker(method, output, **info):
+    # json round trip turns snakemake's Namedlists into plain lists
+    return send_request({'method': method, 
+                         'inputs': json.loads(json.dumps(info)), 
+                         'output': str(output)})
+
+def send_request(request):
+    request = dict(request, cwd=os.getcwd())
+    conn = _workers.get()
+    try:
+        conn.send_bytes(json.dumps(request).encode())
+        reply = json.loads(conn.recv_bytes().decode())
+    finally:
+        _workers.put(conn)
+    if reply['status'] != 'ok':
+        raise RuntimeError('firesnake %s failed:\n%s' % 
+                           (request['method'], reply['traceback']))
+
+def start_workers(n=4, cache_bytes=None):
+    """Start `n` persistent python 2 firesnake workers. Jobs are sent to 
+    whichever worker is free, so imports and cached inputs are reused across
+    rules. Call at the top of a Snakefile.
+    """
+    authkey = os.urandom(16).hex()
+    env = dict(os.environ, **{AUTHKEY_ENV: authkey})
+    cmd = [find_python2(), FIRESNAKE2, 'serve']
+    if cache_bytes is not None:
+        cmd += ['--cache_bytes', str(int(cache_bytes))]
+    for _ in range(n):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env)
+        port = int(p.stdout.readline())
+        _processes.append(p)
+        _workers.put(Client(('localhost', port), authkey=authkey.encode()))
+
+def stop_workers():
+    while _processes:
+        conn = _workers.get()
+        conn.send_bytes(json.dumps({'method': 'shutdown'}).encode())
+        conn.close()
+        _processes.pop().wait()
+
+atexit.register(stop_workers)
 
 def find_python2():
     python2 = shutil.which('python2')
@@ -3,6 +3,8 @@ import hashlib
 import os
 import pickle
 import functools
+import sqlite3
+import weakref
 from collections import defaultdict, namedtuple
 
 # used by `tagged` only
@@ -141,10 +143,13 @@ def is_cached(home, function, inputs, outputs, group_id, entries=None):
         if not os.path.exists(input):
             return False
 
-    if entries is None:
-        entries = load_entries(home)
     for output in outputs:
-        if not check_all_entries(home, function, inputs, output, entries):
+        if entries is None:
+            # indexed lookup
+            entries_ = find_entries(home, output)
+        else:
+            entries_ = entries
+        if not check_all_entries(home, function, inputs, output, entries_):
             return False
             
     return True
@@ -180,25 +185,30 @@ def run(home, function, inputs, outputs, group_id):
     inputs = flatten(inputs)
     entries = []
     for output in outputs:   
-        entries.append(make_entry(function, inputs, output, group_id))
+        entries.append(make_entry(function, inputs, output, group_id, home=home))
 
     return entries
     
 
-def make_entry(function, inputs, output, group_id):
+def make_entry(function, inputs, output, group_id, home=None):
     """
     function gets hashed
     inputs is a list of filenames
     output is a filename
+    if validating by content, file fingerprints are stored too
     """
     
-    return {'flash':  make_flash(function), 
-            'inputs': [(f, os.stat(f)) for f in inputs],
-            'output': (output, os.stat(output)),
-            'group_id': group_id
-           }
-
-def check_entry(function, inputs, output, entry, flash=None):
+    entry = {'flash':  make_flash(function), 
+             'inputs': [(f, os.stat(f)) for f in inputs],
+             'output': (output, os.stat(output)),
+             'group_id': group_id
+            }
+    if validation == 'content':
+        entry['fingerprints'] = {f: file_fingerprint(home, f) 
+                                 for f in list(inputs) + [output]}
+    return entry
+
+def check_entry(function, inputs, output, entry, flash=None, home=None):
     """Can we skip running this function? Before running this, check
     whether the inputs exist.
     - function hasn't changed
@@ -219,7 +229,7 @@ def check_entry(function, inputs, output, entry, flash=None):
             return "file doesn't exist"
         if not f in old_inputs:
             return 'file not in old inputs'
-        if not same_stat(os.stat(f), old_inputs[f]):
+        if not same_file(home, f, old_inputs[f], entry):
             return 'input stat changed', f, old_inputs[f]
 
     
@@ -233,7 +243,7 @@ def check_entry(function, inputs, output, entry, flash=None):
     if not os.path.exists(output):
         return 'the file is gone'
 
-    if not same_stat(os.stat(output), old_stat):
+    if not same_file(home, output, old_stat, entry):
         return 'output stat changed', old_stat, output
                       
     return 'ok'
@@ -241,34 +251,98 @@ def check_entry(function, inputs, output, entry, flash=None):
 def check_all_entries(home, function, inputs, output, entries):
     flash = make_flash(function)
     for entry in entries:
-        check = check_entry(function, inputs, output, entry, flash=flash)
+        check = check_entry(function, inputs, output, entry, flash=flash, home=home)
         if check == 'ok':
             return True
     return False
 
+# ENTRIES
+# entries are stored in an sqlite database, indexed by output filename. Rows
+# are only appended, so concurrent workers can add entries safely. 
+ENTRIES_DB = '.tasker.db'
+LEGACY_ENTRIES = '.tasker'
+_connections = {}
+
+def connect(home):
+    """Open (and cache per process) the entry database in `home`. Entries 
+    from a legacy pickled .tasker file are imported on creation.
+    """
+    key = os.path.abspath(home), os.getpid()
+    if key in _connections:
+        return _connections[key]
+
+    f = os.path.join(home, ENTRIES_DB)
+    legacy = os.path.join(home, LEGACY_ENTRIES)
+    import_legacy = not os.path.exists(f) and os.path.exists(legacy)
+
+    conn = sqlite3.connect(f, timeout=60)
+    with conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                     '(id INTEGER PRIMARY KEY AUTOINCREMENT, output TEXT, entry BLOB)')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_output ON entries (output)')
+        conn.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                     '(path TEXT PRIMARY KEY, size INTEGER, mtime REAL, '
+                     'inode INTEGER, fingerprint TEXT)')
+    _connections[key] = conn
+
+    if import_legacy:
+        with open(legacy, 'r') as fh:
+            add_entries(home, pickle.load(fh)[::-1])
+    return conn
+
 def add_entries(home, entries):
-    old_entries = load_entries(home)
-    create_entries(home, list(entries) + list(old_entries))
+    conn = connect(home)
+    rows = [(entry['output'][0], sqlite3.Binary(pickle.dumps(entry, 2)))
+            for entry in entries]
+    with conn:
+        conn.executemany('INSERT INTO entries (output, entry) VALUES (?, ?)', rows)
+
+def find_entries(home, output):
+    """Entries for one output, newest first.
+    """
+    cursor = connect(home).execute(
+        'SELECT entry FROM entries WHERE output = ? ORDER BY id DESC', (output,))
+    return [pickle.loads(str(row[0])) for row in cursor]
+
+def count_entries(home):
+    return connect(home).execute('SELECT COUNT(*) FROM entries').fetchone()[0]
 
 def delete_entries(home):
-    f = os.path.join(home, '.tasker')
-    os.remove(f)
+    key = os.path.abspath(home), os.getpid()
+    if key in _connections:
+        _connections.pop(key).close()
+    for name in (ENTRIES_DB, LEGACY_ENTRIES):
+        f = os.path.join(home, name)
+        if os.path.exists(f):
+            os.remove(f)
     
 def create_entries(home, entries):
-    f = os.path.join(home, '.tasker')
-    s = pickle.dumps(entries)
-    with open(f, 'w') as fh:
-        fh.write(s)
+    delete_entries(home)
+    add_entries(home, entries)
         
 def load_entries(home):
-    f = os.path.join(home, '.tasker')
-    with open(f, 'r') as fh:
-        return pickle.load(fh)    
+    """All entries, newest first.
+    """
+    cursor = connect(home).execute('SELECT entry FROM entries ORDER BY id DESC')
+    return [pickle.loads(str(row[0])) for row in cursor]
+
+_flashes = weakref.WeakKeyDictionary()
 
 def make_flash(f):
     """If we don't bother hashing, can we look at function code later?
+    Memoized per function object.
     """
-    return hashlib.md5(cloudpickle.dumps(f)).hexdigest()
+    try:
+        return _flashes[f]
+    except (KeyError, TypeError):
+        pass
+    flash = hashlib.md5(cloudpickle.dumps(f)).hexdigest()
+    try:
+        _flashes[f] = flash
+    except TypeError:
+        # not weak-referenceable
+        pass
+    return flash
 
 def partial(f, *args, **kwargs):
     g = functools.partial(f, *args, **kwargs)
@@ -276,9 +350,52 @@ def partial(f, *args, **kwargs):
 
 # DOMAIN-SPECIFIC
 
+# 'mtime' trusts modification times. 'content' accepts files with a new
+# mtime or inode (e.g., copied between machines) if the size and content 
+# fingerprint are unchanged.
+validation = 'mtime'
+
 def same_stat(a, b):
     return a.st_mtime == b.st_mtime
 
+def same_file(home, f, old_stat, entry):
+    """Compare file to its stat and fingerprint when `entry` was made.
+    """
+    stat = os.stat(f)
+    if validation != 'content':
+        return same_stat(stat, old_stat)
+
+    if stat_key(stat) == stat_key(old_stat):
+        return True
+    if stat.st_size != old_stat.st_size:
+        return False
+    old_fingerprint = entry.get('fingerprints', {}).get(f)
+    return old_fingerprint is not None and old_fingerprint == file_fingerprint(home, f)
+
+def file_fingerprint(home, f):
+    """Content fingerprint of a file, stored in the entry database of `home` and
+    recomputed only if the file's size, mtime or inode changed.
+    """
+    from lasagna.versioning import fingerprint
+
+    stat = os.stat(f)
+    if home is None:
+        return fingerprint(f)
+    conn = connect(home)
+    row = conn.execute('SELECT size, mtime, inode, fingerprint FROM fingerprints '
+                       'WHERE path = ?', (f,)).fetchone()
+    if row and tuple(row[:3]) == stat_key(stat):
+        return row[3]
+
+    result = fingerprint(f)
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?)',
+                     (f,) + stat_key(stat) + (result,))
+    return result
+
+def stat_key(stat):
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
 def load_data(f):
     """Generic, replace with domain-specific.
     """
@@ -320,11 +437,10 @@ def loop_schedule(home, file_finder, tasks, n, pool=None):
 
     for i in range(n):
         files = file_finder()
-        entries = load_entries(home)
         # only take jobs from one task
         for task in tasks:
             jobs = task(files)
-            jobs = [job for job in jobs if not is_cached(home, *job, entries=entries)]
+            jobs = [job for job in jobs if not is_cached(home, *job)]
             if jobs:
                 break
 
@@ -333,13 +449,11 @@ def loop_schedule(home, file_finder, tasks, n, pool=None):
         
         if len(jobs) == 0:
             break
-        print  'run %d with %d/%d jobs, checked %d entries' % (i, len(jobs), available_jobs, len(entries))
+        print  'run %d with %d/%d jobs, checked %d entries' % (i, len(jobs), available_jobs, count_entries(home))
         job = jobs[0]
         print '=>', job[2]
         if pool:
             def runner(job):
-                import lasagna.io
-                lasagna.io._get_stack._reset()
                 return run(home, *job)
             new_entries = p.map(runner, jobs[:pool])
             new_entries = flatten(new_entries)
@@ -348,4 +462,119 @@ def loop_schedule(home, file_finder, tasks, n, pool=None):
             add_entries(home, new_entries)
         else:
             new_entries = run(home, *job)
-            add_entries(home, new_entries)
\ No newline at end of file
+            add_entries(home, new_entries)
+
+def build_graph(files, tasks):
+    """Find every job that can eventually run, by applying tasks to the 
+    existing files plus the outputs of jobs found so far, until no new jobs 
+    appear. Returns the jobs and, for each job, the set of indices of jobs 
+    that produce its inputs.
+    """
+    files = set(files)
+    jobs, seen = [], set()
+    while True:
+        new_jobs = []
+        for task in tasks:
+            for job in task(sorted(files)):
+                key = tuple(job.outputs)
+                if key not in seen:
+                    seen.add(key)
+                    new_jobs.append(job)
+        if not new_jobs:
+            break
+        jobs.extend(new_jobs)
+        for job in new_jobs:
+            files.update(job.outputs)
+
+    producers = {}
+    for i, job in enumerate(jobs):
+        for output in job.outputs:
+            producers[output] = i
+
+    dependencies = []
+    for i, job in enumerate(jobs):
+        deps = set(producers[f] for f in flatten(job.inputs) if f in producers)
+        dependencies.append(deps - {i})
+
+    return jobs, dependencies
+
+
+def downstream(dependencies, jobs, candidates):
+    """Jobs, plus the candidates that depend on them directly or indirectly.
+    Jobs need not be in dependency order.
+    """
+    found = set(jobs)
+    changed = True
+    while changed:
+        changed = False
+        for j in candidates - found:
+            if dependencies[j] & found:
+                found.add(j)
+                changed = True
+    return found
+
+
+def schedule(home, file_finder, tasks, processes=4, retries=1, verbose=True):
+    """Build the job graph once, then run jobs in a process pool as soon as
+    the jobs producing their inputs have finished. At most `processes` jobs 
+    run at once. Jobs are skipped if cached, unless a job they depend on has 
+    to run. Failed jobs are retried up to `retries` times; jobs depending on 
+    a failed job are not run.
+
+    Returns lists of completed and failed jobs.
+    """
+    from multiprocess import Pool
+    import time
+
+    jobs, dependencies = build_graph(file_finder(), tasks)
+
+    pending = set(i for i, job in enumerate(jobs) if not is_cached(home, *job))
+    pending = downstream(dependencies, pending, set(range(len(jobs))))
+
+    if verbose:
+        print 'scheduling %d/%d jobs, checked %d entries' % (len(pending), len(jobs), count_entries(home))
+
+    p = Pool(processes)
+    running, attempts = {}, defaultdict(int)
+    completed, failed = [], []
+    try:
+        while pending or running:
+            waiting = pending | set(running)
+            ready = [i for i in sorted(pending) if not dependencies[i] & waiting]
+            for i in ready[:processes - len(running)]:
+                pending.remove(i)
+                attempts[i] += 1
+                running[i] = p.apply_async(run, (home,) + tuple(jobs[i]))
+
+            for i, result in running.items():
+                if not result.ready():
+                    continue
+                del running[i]
+                job = jobs[i]
+                try:
+                    new_entries = result.get()
+                except Exception as e:
+                    if attempts[i] <= retries:
+                        if verbose:
+                            print '=> retrying %s (%s)' % (job.outputs, e)
+                        pending.add(i)
+                        continue
+                    if verbose:
+                        print '=> failed %s (%s)' % (job.outputs, e)
+                    failed.append(job)
+                    # drop everything downstream
+                    pending -= downstream(dependencies, {i}, pending)
+                    continue
+                # the function was pickled to run in the pool
+                for entry in new_entries:
+                    entry['flash'] = make_flash(job.function)
+                add_entries(home, new_entries)
+                completed.append(job)
+                if verbose:
+                    print '[%d/%d] => %s' % (len(completed), len(completed) + len(pending) + len(running), job.outputs)
+            time.sleep(0.05)
+    finally:
+        p.close()
+        p.join()
+
+    return completed, failed
@@ -1,17 +1,39 @@
 from lasagna.io import read_stack
 from lasagna.io import save_stack
-from lasagna.io import montage
-from lasagna.io import pile
-from lasagna.io import subimage
+from lasagna.utils import montage
+from lasagna.utils import pile
+from lasagna.utils import subimage
 from lasagna.io import parse_MM
-from lasagna.io import offset
+from lasagna.utils import offset
 from lasagna.io import read_registered
+from lasagna.io import read_ij_metadata
+from lasagna.io import save_peaks
+from lasagna.io import read_peaks
+from lasagna.utils import object_ids
+from lasagna.utils import offset_inplace
+from lasagna.utils import offset_stack
 
 from lasagna.process import feature_table
 from lasagna.process import build_feature_table
+from lasagna.process import default_intensity_features
+from lasagna.process import default_object_features
 from lasagna.process import alpha_blend
+from lasagna.process import stitch_tiles
+from lasagna.process import register_batch
+from lasagna.process import register_images
+from lasagna.process import log_frames
+from lasagna.process import min_max_filter
+from lasagna.process import find_peaks
+from lasagna.process import window_max
+from lasagna.process import disk_mean
+from lasagna.process import filter_by_region
+from lasagna.process import segment_tiled
 from lasagna.process import find_nuclei
 from lasagna.process import find_cells
+from lasagna.process import packed_regions
+from lasagna.process import packed_reductions
+from lasagna.process import packed_correlation
+from lasagna.process import bbox_correlation
 from nose.tools import assert_raises
 
 import numpy as np
@@ -39,6 +61,10 @@ def test_read_stack():
     data = read_stack(nuclei_compressed)
     assert hash_np(data) == -2955782303036816501
 
+    # compressed pages are decoded on demand
+    data = read_stack(nuclei_compressed, memmap=True)
+    assert hash_np(data[...]) == -2955782303036816501
+
     data = read_stack(stack)
     assert data.shape == (3, 4, 511, 626)
     assert hash_np(data) == 4530181413177493733
@@ -82,6 +108,102 @@ def test_write_stack():
     os.remove(saveto)
 
 
+def test_chunked_stack():
+    import shutil
+    data = read_stack(home('cells.tif'))
+    data = np.array([data, data[::-1]])
+
+    saveto = tmp.next() + '.chunks'
+    save_stack(saveto, data, chunks=(100, 128))
+    data_ = read_stack(saveto)
+
+    assert data_.shape == data.shape
+    assert (data_[...] == data).all()
+
+    # only chunks overlapping the window are read
+    assert (data_[1, 1:, 30:250, 17:400] == data[1, 1:, 30:250, 17:400]).all()
+    assert (data_[:, [3, 1], ::-3, 5] == data[:, [3, 1], ::-3, 5]).all()
+
+    # LUTs and display ranges survive export to .tif
+    saveto_tif = tmp.next() + '.tif'
+    save_stack(saveto_tif, data_)
+    luts, display_ranges = read_ij_metadata(saveto_tif)
+    assert luts == data_.luts
+    assert display_ranges == data_.display_ranges
+    assert hash_np(read_stack(saveto_tif)) == hash_np(data)
+
+    # a store can be saved onto itself
+    save_stack(saveto, read_stack(saveto), chunks=(64, 64))
+    assert (read_stack(saveto)[...] == data).all()
+
+    # missing chunks are an error, not zeros
+    os.remove(os.path.join(saveto, '0.0.0.0'))
+    assert_raises(IOError, lambda: read_stack(saveto)[0, 0, :10, :10])
+
+    shutil.rmtree(saveto)
+    os.remove(saveto_tif)
+
+
+def test_lru_cache():
+    from lasagna.utils import lru_cache
+
+    calls = []
+
+    @lru_cache(max_bytes=2500)
+    def f(x):
+        calls.append(x)
+        return np.zeros(1000, dtype=np.uint8)
+
+    for i in range(3):
+        f(np.arange(i))
+    # least recently used value was evicted
+    f(np.arange(2))
+    f(np.arange(0))
+    stats = f.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 4, 2)
+    assert stats['nbytes'] <= 2500
+
+    # cached values are copied
+    f(np.arange(2))[:] = 1
+    assert f(np.arange(2)).sum() == 0
+
+
+def test_cache_budget():
+    from lasagna.utils import CacheBudget, LRUCache
+
+    class Handle(object):
+        cache_nbytes = 100
+        closed = False
+        def close(self):
+            self.closed = True
+
+    # caches share one budget, least recently used values are closed
+    budget = CacheBudget(max_bytes=250, max_entries=3)
+    f, g = LRUCache(lambda x: Handle()), LRUCache(lambda x: Handle())
+    f.budget = g.budget = budget
+    a, b = f(0), g(0)
+    assert f(0) is a
+    c = g(1)
+    assert b.closed and not a.closed
+    assert (budget.nbytes, len(budget.entries)) == (200, 2)
+
+    budget.set_limits(max_bytes=1000, max_entries=1)
+    assert a.closed and not c.closed
+    g.budget.reset(g)
+    assert c.closed and budget.nbytes == 0
+
+
+def test_object_ids():
+    labels = read_stack(nuclei)
+    labels = np.unique(labels[labels > 0])
+    ids = object_ids(labels, file='A1', tile=3)
+    assert ids.dtype == np.int64
+    assert (ids == object_ids(labels, file='A1', tile='3')).all()
+    assert (ids & (2**24 - 1) == labels).all()
+    assert not set(ids) & set(object_ids(labels, file='A1', tile=4))
+    assert_raises(ValueError, object_ids, [-1])
+
+
 def test_montage():
     data = read_stack(stack)
     data = data[..., :400, :500]
@@ -132,6 +254,20 @@ def test_offset():
     assert data_[1, 0, 4, 8] == data[0, 1, 0, 0]
 
 
+def test_offset_stack():
+    data = read_stack(home('cells.tif'))
+    data = np.array([data, data[::-1]])
+
+    offsets = np.array([[3, -5], [-20, 7]] * 5).reshape(2, 5, 2)
+    data_ = offset_stack(data, offsets)
+    assert (data_[1, 2] == offset(data[1, 2], offsets[1, 2])).all()
+    assert data_[0, 0, 3, 0] == data[0, 0, 0, 5]
+    assert (data_[0, 0, :3] == 0).all()
+
+    offset_inplace(data[1, 2], offsets[1, 2])
+    assert (data_[1, 2] == data[1, 2]).all()
+
+
 def test_parse_MM():
     cases = (("100X_round1_1_MMStack_A1-Site_15.ome.tif",
               ('100X', 1, 'A1', 15)),
@@ -179,6 +315,57 @@ def test_build_feature_table():
     assert (df == df_).all().all()
 
 
+def test_vectorized_features():
+    features = default_intensity_features.copy()
+    for k in ('area', 'y', 'x', 'bounds', 'label'):
+        features[k] = default_object_features[k]
+    # wrapped functions aren't recognized, so they run per region
+    per_region = {k: (lambda f: lambda r: f(r))(f) for k, f in features.items()}
+
+    data = read_stack(home('cells.tif'))
+    index = (('channel', range(4)),)
+    df = build_feature_table(data[:4], data[4], features, index)
+    df_ = build_feature_table(data[:4], data[4], per_region, index)
+
+    assert list(df.columns) == list(df_.columns)
+    assert (df['bounds'] == df_['bounds']).all()
+    df, df_ = df.drop('bounds', axis=1), df_.drop('bounds', axis=1)
+    assert (df.dtypes == df_.dtypes).all()
+    assert np.allclose(df, df_)
+
+    df = feature_table(data[0], data[4], {'area': 'area', 'sum': 'sum'})
+    assert np.allclose(df['sum'], df_['mean'][:len(df)] * df['area'])
+
+
+def test_register_batch():
+    from skimage.feature import register_translation
+    from scipy.ndimage import shift
+
+    reference = read_stack(home('fused.tif')).astype(float)
+    images = [shift(reference, s, order=1) for s in [(3, -7), (-10.5, 4.2)]]
+
+    for upsample in (1, 10):
+        shifts = register_batch(reference, images, upsample=upsample, threads=2)
+        for image, s in zip(images, shifts):
+            s_ = register_translation(reference, image, upsample_factor=upsample)[0]
+            assert np.allclose(s, s_)
+
+    assert_raises(ValueError, register_batch, reference, [reference[1:]])
+
+
+def test_register_pyramid():
+    from scipy.ndimage import gaussian_filter, shift
+
+    rs = np.random.RandomState(0)
+    image = gaussian_filter(rs.rand(1000, 1200), 3)
+    images = [image, shift(image, (300, -20), order=1), rs.rand(1000, 1200)]
+
+    offsets, confidence = register_images(images, levels=3, window=(200, 200), 
+                                          return_confidence=True)
+    assert np.allclose(offsets[1], (-300, 20))
+    assert confidence[1] > 2 > confidence[2]
+
+
 def test_alpha_blend():
     tiles = ['tile_%d.tif' % i for i in range(4)]
     arr = [read_stack(home(t)) for t in tiles]
@@ -191,6 +378,124 @@ def test_alpha_blend():
     assert average_diff < 1.
 
 
+def test_stitch_tiles():
+    tiles = [read_stack(home('tile_%d.tif' % i)) for i in range(4)]
+    positions = stitch_tiles([tiles[:2], tiles[2:]], overlap=0.3)
+    assert np.allclose(positions, [(0, 0), (0, 250), (189, 0), (181, 310)])
+
+    fused = alpha_blend(tiles, positions, clip=False)
+    fused_ = read_stack(home('fused.tif'))
+    average_diff = np.abs(fused.astype(float) - fused_.astype(float)).sum() / fused.size
+
+    assert average_diff < 1.
+
+
+def test_alpha_blend_blocks():
+    import shutil
+    tiles = [read_stack(home('tile_%d.tif' % i)) for i in range(4)]
+    positions = [(0, 0), (0, 250), (189, 0), (181, 310)]
+
+    fused = alpha_blend(tiles, positions)
+    mosaic = alpha_blend(tiles, positions, block_shape=(100, 128))
+    assert mosaic.shape == fused.shape
+    assert np.abs(mosaic[...].astype(float) - fused).max() <= 1
+
+    saveto = tmp.next() + '.chunks'
+    fused_ = alpha_blend(tiles, positions, clip=False, out=saveto)
+    fused = alpha_blend(tiles, positions, clip=False)
+    covered = ~np.isnan(alpha_blend([np.ones(t.shape) for t in tiles], positions, clip=False))
+    assert fused_.shape == fused.shape
+    assert np.abs(fused_[...].astype(float) - fused)[covered].max() <= 1
+    assert (fused_[...][~covered] == 0).all()
+    shutil.rmtree(saveto)
+
+    # subpixel placement
+    fused = alpha_blend(tiles, positions, clip=False)
+    assert (alpha_blend(tiles, positions, clip=False, subpixel=True) == fused).all()
+    positions = np.array(positions) + [(0.3, 0), (0, 0.6), (0.25, 0.5), (0.7, 0.1)]
+    fused = alpha_blend(tiles, positions, subpixel=True)
+    mosaic = alpha_blend(tiles, positions, subpixel=True, block_shape=(100, 128))
+    assert np.abs(mosaic[...].astype(float) - fused).max() <= 1
+
+
+def test_log_frames():
+    from scipy.ndimage.filters import gaussian_laplace
+    data = read_stack(home('cells.tif'))[:4]
+
+    for sigma in (1, 10):
+        loged_ = np.array([gaussian_laplace(x.astype(float), sigma) for x in data])
+        scale = np.abs(loged_).max()
+        for fft in (False, True):
+            loged = log_frames(data, sigma, fft=fft)
+            assert loged.dtype == np.float32
+            assert np.abs(loged - loged_).max() < 1e-5 * scale
+
+
+def test_min_max_filter():
+    from scipy.ndimage import filters
+    data = read_stack(home('cells.tif'))[:4]
+    data = np.array([data, data[:, ::-1]])
+
+    for n in (1, 4, 5, 40):
+        size = (1, 1, n, n)
+        data_min, data_max = min_max_filter(data, n)
+        assert data_max.dtype == data.dtype
+        assert (data_min == filters.minimum_filter(data, size)).all()
+        assert (data_max == filters.maximum_filter(data, size)).all()
+
+    # windows gathered at a few pixels, including edges
+    i, j = [0, 510, 3, 200], [625, 0, 1, 300]
+    values = window_max(data, i, j, 5)
+    assert (values == filters.maximum_filter(data, (1, 1, 5, 5))[..., i, j]).all()
+
+    peaks = find_peaks(data)
+    assert (peaks[..., :5, :] == 0).all()
+    assert (peaks[data != filters.maximum_filter(data, (1, 1, 5, 5))] == 0).all()
+
+
+def test_sparse_peaks():
+    cells = read_stack(home('cells.tif'))
+    peaks = find_peaks(cells[:4])
+    peaks[peaks < 50] = 0
+
+    saveto = tmp.next() + '.npz'
+    save_peaks(saveto, peaks)
+    df = read_peaks(saveto)
+    assert len(df) == (peaks > 0).sum()
+    assert (peaks[df['frame'], df['i'], df['j']] == df['value']).all()
+    assert (read_peaks(saveto, dense=True) == peaks).all()
+
+    os.remove(saveto)
+
+
+def test_disk_mean():
+    import skimage
+    import skimage.filters.rank
+    from skimage.morphology import disk
+    data = skimage.img_as_ubyte(read_stack(home('cells.tif'))[0])
+
+    for radius in (1, 15):
+        mean_ = skimage.filters.rank.mean(data, selem=disk(radius))
+        mean = disk_mean(data, radius)
+        assert mean.dtype == np.float32
+        assert np.abs(mean - mean_).max() < 1
+
+
+def test_filter_by_region():
+    data = read_stack(home('cells.tif'))
+    cells = data[-1]
+
+    large = filter_by_region(cells, 'area', lambda a: a > 3000)
+    large_ = filter_by_region(cells, lambda r: r.area > 3000, None)
+    assert (large == large_).all()
+    assert 0 < len(np.unique(large)) < len(np.unique(cells))
+
+    bright = filter_by_region(cells, 'mean', np.median, intensity=data[0])
+    bright_ = filter_by_region(cells, lambda r: r.mean_intensity, np.median, 
+                               intensity=data[0])
+    assert (bright == bright_).all()
+
+
 def test_find_nuclei():
     data = read_stack(home('stack.tif'))
     mask = find_nuclei(data[0][0], um_per_px=0.35)
@@ -200,6 +505,92 @@ def test_find_nuclei():
     assert (mask == mask_).all()
 
 
+def test_find_cells_distance():
+    import skimage.measure
+    nuclei_ = read_stack(nuclei)
+    mask = read_stack(home('mask.tif'))
+
+    cells = find_cells(nuclei_, mask, small_holes=0, method='distance')
+    cells_ = find_cells(nuclei_, mask, small_holes=0, method='fmm')
+    assert (cells == cells_).mean() > 0.999
+
+    capped = find_cells(nuclei_, mask, small_holes=0, method='distance', 
+                        max_distance=20)
+    assert ((capped > 0) <= (cells > 0)).all()
+    assert (capped > 0).sum() < (cells > 0).sum()
+
+    # small holes are assigned to a neighboring cell
+    filled = find_cells(nuclei_, mask, small_holes=100, method='distance')
+    holes = skimage.measure.label(filled == 0)
+    areas = np.bincount(holes.ravel())[1:]
+    assert (areas >= 100).all()
+
+
+def test_blank_image():
+    blank = np.zeros((300, 300), dtype=np.uint16)
+    nuclei_ = find_nuclei(blank, um_per_px=0.35)
+    assert nuclei_.shape == blank.shape and nuclei_.max() == 0
+
+    for method in ('fmm', 'distance'):
+        for mask in (blank > 0, blank == 0):
+            cells = find_cells(nuclei_, mask, method=method)
+            assert cells.max() == 0
+
+
+def test_segment_tiled():
+    dapi = read_stack(home('cells.tif'))[0]
+    nuclei = find_nuclei(dapi, um_per_px=0.35)
+
+    # one block
+    nuclei_ = segment_tiled(find_nuclei, dapi, processes=1, um_per_px=0.35)
+    assert (nuclei_ == nuclei).all()
+
+    # objects crossing seams are kept once
+    nuclei_ = segment_tiled(find_nuclei, dapi, block_shape=(256, 256), 
+                            overlap=64, processes=2, um_per_px=0.35)
+    assert ((nuclei_ > 0) == (nuclei > 0)).mean() > 0.99
+    assert abs(len(np.unique(nuclei_)) - len(np.unique(nuclei))) <= 2
+
+    # blank blocks next to populated ones
+    padded = np.zeros((dapi.shape[0], dapi.shape[1] + 300), dtype=dapi.dtype)
+    padded[:, :dapi.shape[1]] = dapi
+    nuclei = find_nuclei(padded, um_per_px=0.35)
+    nuclei_ = segment_tiled(find_nuclei, padded, block_shape=(256, 256), 
+                            overlap=64, processes=2, um_per_px=0.35)
+    assert (nuclei_[:, dapi.shape[1]:] == 0).all()
+    assert ((nuclei_ > 0) == (nuclei > 0)).mean() > 0.99
+
+
+def test_packed_regions():
+    import skimage.measure
+    data = read_stack(home('cells.tif'))[:2]
+    nuclei_ = read_stack(nuclei)
+
+    packed = packed_regions(nuclei_, data, fill_holes=True)
+    reductions = packed_reductions(packed, 1, ['median', 'sum', 'max'])
+    corr = packed_correlation(packed, 0, 1)
+    corr_bbox = bbox_correlation(nuclei_, data[0], data[1])
+
+    regions = skimage.measure.regionprops(nuclei_)
+    assert (packed['labels'] == [r.label for r in regions]).all()
+    for k, r in enumerate(regions):
+        i0, j0, i1, j1 = r.bbox
+        dapi, gfp = data[:, i0:i1, j0:j1][:, r.filled_image].astype(float)
+        assert reductions['median'][k] == np.median(gfp)
+        assert reductions['sum'][k] == gfp.sum()
+        assert reductions['max'][k] == gfp.max()
+        assert np.isclose(corr[k], np.corrcoef(dapi, gfp)[0, 1])
+        dapi, gfp = data[:, i0:i1, j0:j1].reshape(2, -1)
+        assert np.isclose(corr_bbox[k], np.corrcoef(dapi, gfp)[0, 1])
+
+    # labels that are not present give NaN
+    missing = nuclei_.max() + 1
+    corr_missing = bbox_correlation(nuclei_, data[0], data[1], 
+                                    index=[regions[0].label, missing])
+    assert np.isclose(corr_missing[0], corr_bbox[0])
+    assert np.isnan(corr_missing[1])
+
+
 def test_find_cells():
     import skimage.morphology
     import lasagna.process
@@ -213,3 +604,117 @@ def test_find_cells():
     cells_ = read_stack(home('cells.tif'))
 
     assert (cells == cells_[-1]).all()
+
+
+def test_tasker_schedule():
+    import shutil, tempfile, time
+    from lasagna import tasker
+
+    root = tempfile.mkdtemp()
+    path = lambda name: os.path.join(root, name)
+
+    def add_one(inputs, output, fail_once=None):
+        if fail_once and not os.path.exists(fail_once):
+            open(fail_once, 'w').close()
+            raise ValueError('first attempt fails')
+        x = sum(int(open(f).read()) for f in inputs)
+        with open(output, 'w') as fh:
+            fh.write(str(x + 1))
+
+    def chain(fail_once=None):
+        def task_b(files):
+            if path('a.txt') in files:
+                f = tasker.partial(add_one, [path('a.txt')], path('b.txt'), 
+                                   fail_once=fail_once)
+                return [tasker.Job(f, [path('a.txt')], [path('b.txt')], 'b')]
+            return []
+        def task_c(files):
+            if path('b.txt') in files:
+                f = tasker.partial(add_one, [path('b.txt')], path('c.txt'))
+                return [tasker.Job(f, [path('b.txt')], [path('c.txt')], 'c')]
+            return []
+        # c depends on b, which does not exist yet
+        return [task_c, task_b]
+
+    def schedule(tasks, retries=1):
+        return tasker.schedule(root, lambda: tasker.find_files(root), tasks, 
+                               processes=2, retries=retries, verbose=False)
+
+    try:
+        with open(path('a.txt'), 'w') as fh:
+            fh.write('1')
+
+        # jobs run in dependency order
+        completed, failed = schedule(chain())
+        assert len(completed) == 2 and not failed
+        assert open(path('c.txt')).read() == '3'
+        assert tasker.count_entries(root) == 2
+
+        # cached jobs are skipped
+        completed, failed = schedule(chain())
+        assert completed == [] and failed == []
+
+        # jobs downstream of a changed input run again
+        time.sleep(0.01)
+        with open(path('a.txt'), 'w') as fh:
+            fh.write('5')
+        os.utime(path('a.txt'), (time.time() + 10,) * 2)
+        completed, failed = schedule(chain())
+        assert [job.group_id for job in completed] == ['b', 'c']
+        assert open(path('c.txt')).read() == '7'
+
+        # failed jobs are retried
+        os.remove(path('b.txt'))
+        completed, failed = schedule(chain(fail_once=path('marker')))
+        assert len(completed) == 2 and not failed
+
+        # without retries, jobs downstream of a failure don't run
+        os.remove(path('b.txt'))
+        os.remove(path('marker'))
+        completed, failed = schedule(chain(fail_once=path('marker')), retries=0)
+        assert completed == [] and [job.group_id for job in failed] == ['b']
+    finally:
+        tasker.delete_entries(root)
+        shutil.rmtree(root)
+
+
+def test_tasker_content_validation():
+    import shutil, tempfile, time
+    from lasagna import tasker, versioning
+
+    root = tempfile.mkdtemp()
+    input_, output = os.path.join(root, 'a.txt'), os.path.join(root, 'b.txt')
+    f = lambda: shutil.copy(input_, output)
+    validation = tasker.validation
+    try:
+        with open(input_, 'w') as fh:
+            fh.write('abc')
+        tasker.validation = 'content'
+        tasker.add_entries(root, tasker.run(root, f, [input_], [output], 'b'))
+        assert tasker.is_cached(root, f, [input_], [output], 'b')
+
+        # a new mtime with the same content is still cached
+        os.utime(input_, (time.time() + 10,) * 2)
+        assert tasker.is_cached(root, f, [input_], [output], 'b')
+        tasker.validation = 'mtime'
+        assert not tasker.is_cached(root, f, [input_], [output], 'b')
+
+        # different content of the same size is not
+        tasker.validation = 'content'
+        with open(input_, 'w') as fh:
+            fh.write('abd')
+        os.utime(input_, (time.time() + 20,) * 2)
+        assert not tasker.is_cached(root, f, [input_], [output], 'b')
+
+        # md5sums are recomputed after changes, keeping one entry per file
+        checksum = versioning.md5sum(input_)
+        assert checksum == hashlib.md5('abd').hexdigest()
+        with open(input_, 'w') as fh:
+            fh.write('abcd')
+        checksum_ = versioning.md5sum(input_)
+        assert checksum_ == hashlib.md5('abcd').hexdigest()
+        assert versioning._md5sums[os.path.abspath(input_)][1] == checksum_
+    finally:
+        tasker.validation = validation
+        tasker.delete_entries(root)
+        shutil.rmtree(root)
@@ -1,4 +1,9 @@
 import functools
+import hashlib
+import mmap
+import os
+import sys
+import threading
 import regex as re
 import numpy as np
 import pandas as pd
@@ -50,6 +55,228 @@ class Memoized(object):
         self.cache = {}
 
 
+CACHE_BYTES_ENV = 'LASAGNA_CACHE_BYTES'
+CACHE_BYTES = 2 * 1024**3
+CACHE_ENTRIES = 256
+
+
+class CacheBudget(object):
+    """Byte and entry limits shared by LRUCaches. When either is exceeded, 
+    the least recently used value of any cache in the budget is evicted and 
+    closed if it has a close() method (e.g., a lasagna.io.TiffStack holding
+    an open file). 
+    """
+
+    def __init__(self, max_bytes=None, max_entries=CACHE_ENTRIES):
+        if max_bytes is None:
+            max_bytes = int(float(os.environ.get(CACHE_BYTES_ENV, CACHE_BYTES)))
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # (cache id, key) => (value, size), least recently used first
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, owner, key):
+        """Return (True, value) and mark value as recently used, or 
+        (False, None).
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop((owner, key))
+            except KeyError:
+                return False, None
+            self.entries[(owner, key)] = entry
+            return True, entry[0]
+
+    def add(self, owner, key, value):
+        size = cache_nbytes(value)
+        with self.lock:
+            self._remove((owner, key))
+            if size > self.max_bytes:
+                return
+            self.entries[(owner, key)] = value, size
+            self.nbytes += size
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while (self.nbytes > self.max_bytes or 
+                    (self.max_entries is not None and 
+                     len(self.entries) > self.max_entries)):
+                _, (value, size) = self.entries.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+                close_cached(value)
+
+    def set_limits(self, max_bytes=None, max_entries=None):
+        with self.lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_entries is not None:
+                self.max_entries = max_entries
+            self.evict()
+
+    def reset(self, owner=None):
+        """Drop values of one cache, or of all caches.
+        """
+        with self.lock:
+            for k in list(self.entries):
+                if owner is None or k[0] is owner:
+                    self._remove(k)
+
+    def count(self, owner):
+        with self.lock:
+            return sum(1 for k in self.entries if k[0] is owner)
+
+    def _remove(self, k):
+        if k in self.entries:
+            value, size = self.entries.pop(k)
+            self.nbytes -= size
+            close_cached(value)
+
+
+cache_budget = CacheBudget()
+
+
+def set_cache_budget(max_bytes=None, max_entries=None):
+    """Change the limits of the budget shared by all lasagna caches, evicting
+    values as needed.
+    """
+    cache_budget.set_limits(max_bytes=max_bytes, max_entries=max_entries)
+
+
+def close_cached(value):
+    close = getattr(value, 'close', None)
+    if callable(close) and not isinstance(value, np.ndarray):
+        close()
+
+
+class LRUCache(object):
+    """Decorator that caches a function's return value, evicting the least 
+    recently used values once the budget is exceeded. By default all caches 
+    share one budget, `cache_budget`, of LASAGNA_CACHE_BYTES (environment 
+    variable, default CACHE_BYTES) and CACHE_ENTRIES values; see 
+    `set_cache_budget`. If `max_bytes` is given the cache gets its own budget.
+
+    Arguments naming existing files are keyed by (path, mtime, size), so 
+    values are recomputed after the file changes. Numpy arrays are keyed by 
+    shape, dtype and a hash of their contents. Cached arrays are copied 
+    unless called with copy=False, as in Memoized; memory-mapped arrays are 
+    never copied. Only their mapping is held, so they count as 0 bytes and 
+    are bounded by the number of entries.
+    """
+
+    def __init__(self, func, max_bytes=None, max_entries=CACHE_ENTRIES):
+        if max_bytes is None:
+            self.budget = cache_budget
+        else:
+            self.budget = CacheBudget(max_bytes, max_entries=max_entries)
+        self.func = func
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        functools.update_wrapper(self, func)
+
+    def __call__(self, *args, **kwargs):
+        key = (cache_key(args), 
+               cache_key({k: v for k, v in kwargs.items() if k != 'copy'}))
+        hit, value = self.budget.get(self, key)
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if not hit:
+            value = self.func(*args, **kwargs)
+            self.budget.add(self, key, value)
+
+        if isinstance(value, np.ndarray) and not is_memmapped(value):
+            if kwargs.get('copy', True):
+                return value.copy()
+        return value
+
+    def stats(self):
+        """Hits and misses of this cache; evictions, size and limits of its
+        budget.
+        """
+        return {'hits': self.hits, 'misses': self.misses, 
+                'evictions': self.budget.evictions, 
+                'entries': self.budget.count(self),
+                'nbytes': self.budget.nbytes, 
+                'max_bytes': self.budget.max_bytes}
+
+    def __repr__(self):
+        return '<LRUCache %s: %s>' % (self.func.__name__, self.stats())
+
+    def __get__(self, obj, objtype):
+        """Support instance methods."""
+        fn = functools.partial(self.__call__, obj)
+        fn.reset = self._reset
+        return fn
+
+    def _reset(self):
+        self.budget.reset(self)
+
+
+def lru_cache(max_bytes=None):
+    """Decorator factory for LRUCache with a byte budget.
+    """
+    def wrapper(func):
+        return LRUCache(func, max_bytes=max_bytes)
+    return wrapper
+
+
+def cache_key(x):
+    """Cheap hashable key for function arguments.
+    """
+    if isinstance(x, basestring):
+        if os.path.isfile(x):
+            stat = os.stat(x)
+            return x, stat.st_mtime, stat.st_size
+        return x
+    if isinstance(x, np.ndarray):
+        data = np.ascontiguousarray(x)
+        return ('ndarray', x.shape, x.dtype.str, 
+                hashlib.md5(data.view(np.uint8)).hexdigest())
+    if isinstance(x, (list, tuple)):
+        return type(x).__name__, tuple(cache_key(y) for y in x)
+    if isinstance(x, dict):
+        return 'dict', tuple(sorted((k, cache_key(v)) for k, v in x.items()))
+    try:
+        hash(x)
+        return x
+    except TypeError:
+        return repr(x)
+
+
+def is_memmapped(arr):
+    """True if array data lives in a memory-mapped file.
+    """
+    while isinstance(arr, np.ndarray):
+        if isinstance(arr, np.memmap):
+            return True
+        arr = arr.base
+    return isinstance(arr, mmap.mmap)
+
+
+def cache_nbytes(x):
+    """Approximate memory held by a cached value. Objects may report their 
+    own size with a `cache_nbytes` attribute (e.g., the most a 
+    lasagna.io.TiffStack keeps in decoded pages).
+    """
+    if hasattr(x, 'cache_nbytes'):
+        return x.cache_nbytes
+    if isinstance(x, np.ndarray):
+        return 0 if is_memmapped(x) else x.nbytes
+    if isinstance(x, (pd.DataFrame, pd.Series)):
+        return int(np.sum(x.memory_usage(deep=True)))
+    if isinstance(x, (list, tuple)):
+        return sum(cache_nbytes(y) for y in x)
+    return sys.getsizeof(x)
+
+
 def compress_obj(obj):
     s = StringIO.StringIO()
     pickle.dump(obj, s)
@@ -223,6 +450,30 @@ def groupby_reduce_concat(gb, **kwargs):
     return pd.concat(arr, axis=1)
 
 
+OBJECT_ID_LABEL_BITS = 24
+
+def object_ids(labels, file='', tile=0, frame=0):
+    """Deterministic 64-bit integer IDs for labeled objects. The low 24 bits 
+    hold the label and the rest a hash of (file, tile, frame), so IDs from 
+    different tiles can be merged as integers. Always non-negative.
+
+        df['id'] = object_ids(df['cell'], file=well, tile=tile)
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if labels.size and (labels.min() < 0 or labels.max() >> OBJECT_ID_LABEL_BITS):
+        raise ValueError('labels must be in [0, 2**%d)' % OBJECT_ID_LABEL_BITS)
+    key = '%s/%s/%s' % (file, tile, frame)
+    prefix = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+    prefix >>= OBJECT_ID_LABEL_BITS + 1
+    return (prefix << OBJECT_ID_LABEL_BITS) | labels
+
+
+def object_id(label, file='', tile=0, frame=0):
+    """Scalar version of `object_ids`.
+    """
+    return int(object_ids(label, file=file, tile=tile, frame=frame))
+
+
 # GLUE
 def show_grid(z, force_fit=False):
     import qgrid
@@ -690,10 +941,13 @@ def subimage(stack, bbox, pad=0):
     return sub
 
 
-def offset(stack, offsets):
+def offset(stack, offsets, out=None):
     """Applies offset to stack, fills with zero. Only applies integer offsets.
+    Shifted data is written once, into `out` if provided; pass out=stack to 
+    shift in place (see `offset_inplace`).
     :param stack: N-dim array
     :param offsets: list of N offsets
+    :param out: array with the shape of stack
     :return:
     """
     if len(offsets) != stack.ndim:
@@ -704,18 +958,114 @@ def offset(stack, offsets):
 
     offsets = np.array(offsets).astype(int)
 
-    n = stack.ndim
-    ns = (slice(None),)
-    for d, offset in enumerate(offsets):
-        stack = np.roll(stack, offset, axis=d)
-        if offset < 0:
-            index = ns * d + (slice(offset, None),) + ns * (n - d - 1)
-            stack[index] = 0
-        if offset > 0:
-            index = ns * d + (slice(None, offset),) + ns * (n - d - 1)
-            stack[index] = 0
-
-    return stack    
+    if out is None:
+        out = np.zeros_like(stack)
+        zeroed = True
+    else:
+        zeroed = False
+
+    source, target = [], []
+    for n, offset in zip(stack.shape, offsets):
+        offset = int(np.clip(offset, -n, n))
+        source += [slice(max(-offset, 0), n - max(offset, 0))]
+        target += [slice(max(offset, 0), n - max(-offset, 0))]
+
+    # overlapping source and target are handled by numpy
+    out[tuple(target)] = stack[tuple(source)]
+
+    if not zeroed:
+        ns = (slice(None),)
+        for d, offset in enumerate(offsets):
+            if offset < 0:
+                out[ns * d + (slice(offset, None),)] = 0
+            if offset > 0:
+                out[ns * d + (slice(None, offset),)] = 0
+
+    return out
+
+
+def offset_inplace(stack, offsets):
+    """Applies offset to stack without allocating a new array.
+    """
+    return offset(stack, offsets, out=stack)
+
+
+def offset_stack(stack, offsets, out=None):
+    """Applies a different 2D offset to each frame of a [..., height, width] 
+    stack in one pass, e.g., a [cycle, channel] array of offsets for a
+    [cycle, channel, height, width] stack. Pass out=stack to shift in place.
+    :param stack: N-dim array
+    :param offsets: array with shape stack.shape[:-2] + (2,)
+    :param out: array with the shape of stack
+    :return:
+    """
+    offsets = np.asarray(offsets)
+    if offsets.shape != stack.shape[:-2] + (2,):
+        raise ValueError('offsets must have shape %s' % (stack.shape[:-2] + (2,),))
+
+    if out is None:
+        out = np.zeros_like(stack)
+    for index in np.ndindex(*stack.shape[:-2]):
+        offset(stack[index], offsets[index], out=out[index])
+    return out
+
+
+def map_frames(f, stack, out=None, dtype=None, threads=4):
+    """Applies `f(frame, output)` to each 2D frame of a [..., height, width]
+    stack, writing into the matching frame of `out`. Frames are processed in
+    a thread pool, which helps for functions that release the GIL (e.g.,
+    scipy.ndimage filters).
+    :param f: function of (frame, output) that fills output in place, or of
+        (frame, output_0, output_1, ...) if out is a tuple
+    :param stack: N-dim array
+    :param out: preallocated array with the shape of stack, or a tuple of them
+    :param dtype: dtype of out if it is allocated, defaults to stack.dtype
+    :param threads: number of threads, run serially if None or 1
+    :return: out
+    """
+    if out is None:
+        out = np.empty(stack.shape, dtype=dtype or stack.dtype)
+    outs = out if isinstance(out, tuple) else (out,)
+    for x in outs:
+        if x.shape != stack.shape:
+            raise ValueError('out has shape %s, stack has shape %s' %
+                             (x.shape, stack.shape))
+
+    indices = list(np.ndindex(*stack.shape[:-2]))
+    apply = lambda index: f(stack[index], *[x[index] for x in outs])
+    thread_map(apply, indices, threads=threads)
+    return out
+
+
+def thread_map(f, xs, threads=4):
+    """Like map, in a thread pool of at most `threads` threads. Runs serially 
+    if threads is None or 1. The pool is shut down and joined when done or 
+    if f raises.
+    """
+    xs = list(xs)
+    if not threads or threads <= 1 or len(xs) <= 1:
+        return map(f, xs)
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(xs)))
+    try:
+        return pool.map(f, xs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def imap_bounded(pool, f, iterable, window):
+    """Like pool.imap, but submits at most `window` tasks ahead of the results
+    consumed, so lazily produced inputs are not all held in memory.
+    """
+    from collections import deque
+    pending = deque()
+    for x in iterable:
+        pending.append(pool.apply_async(f, (x,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
 
 
 def to_nd_array(x):
@@ -4,6 +4,7 @@ import hashlib
 import joblib
 import tempfile
 import os
+import zlib
 
 from collections import defaultdict
 
@@ -62,15 +63,42 @@ def none_on_IOError(f, *args, **kwargs):
         return None
         
 
+# path => (stat_key, md5), one entry per file
+_md5sums = {}
+
 @none_on_IOError
 def md5sum(filename, blocksize=65536):
-    """Faster than calling OSX md5 utility via subprocess.
+    """Faster than calling OSX md5 utility via subprocess. Recomputed only 
+    if the file's size, mtime or inode changed.
     """
+    path = os.path.abspath(filename)
+    key = stat_key(os.stat(filename))
+    if path in _md5sums and _md5sums[path][0] == key:
+        return _md5sums[path][1]
+
     hsh = hashlib.md5()
     with open(filename, 'rb') as f:
         for block in iter(lambda: f.read(blocksize), b''):
             hsh.update(block)
-    return hsh.hexdigest()
+    _md5sums[path] = key, hsh.hexdigest()
+    return _md5sums[path][1]
+
+
+def stat_key(stat):
+    return stat.st_size, stat.st_mtime, stat.st_ino
+
+
+def fingerprint(filename, blocksize=1 << 20):
+    """Fast, non-cryptographic fingerprint of file contents: crc32 over the 
+    whole file, read in blocks, prefixed by the size. Unlike stat, survives 
+    copying between machines.
+    """
+    size = os.path.getsize(filename)
+    crc = zlib.crc32(str(size))
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            crc = zlib.crc32(block, crc)
+    return '%d-%08x' % (size, crc & 0xffffffff)
 
 
 